@@ -9,6 +9,9 @@ from flask_compress import Compress
 from concurrent.futures import ThreadPoolExecutor
 from dateutil.relativedelta import relativedelta
 from flask_cors import CORS # Adicionado import para CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
+import atexit
+from reservas import ReservaManager, LimiteReserva
 
 # Configuração de logging
 logging.basicConfig(level=logging.DEBUG)
@@ -16,6 +19,10 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 app = Flask(__name__)
+# Número de proxies reversos à frente da API; com 0, request.remote_addr é o IP da conexão
+PROXIES_CONFIAVEIS = int(os.environ.get('PROXIES_CONFIAVEIS', 0))
+if PROXIES_CONFIAVEIS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXIES_CONFIAVEIS)
 Compress(app)  # Ativa compressão Gzip
 cache = TTLCache(maxsize=100, ttl=300)  # Cache com expiração de 5 minutos
 executor = ThreadPoolExecutor(2)  # Pool de threads para operações I/O
@@ -39,6 +46,16 @@ except Exception as e:
     logger.critical(f"Erro ao conectar com Supabase: {str(e)}")
     supabase = None
 
+# Reservas temporárias de cotas durante a negociação (gravadas em segundo plano na coluna `reserva`)
+reservas = ReservaManager(
+    supabase,
+    ttl=int(os.environ.get('RESERVA_TTL_SEGUNDOS', 900)),
+    max_cotas=int(os.environ.get('RESERVA_MAX_COTAS', 10)),
+    max_por_cliente=int(os.environ.get('RESERVA_MAX_POR_CLIENTE', 3)),
+    max_renovacoes=int(os.environ.get('RESERVA_MAX_RENOVACOES', 8))
+)
+atexit.register(reservas.parar)
+
 # ==================== ROTAS ====================
 
 @app.route('/health')
@@ -50,7 +67,8 @@ def health_check():
             "status": "healthy" if db_ok else "degraded",
             "supabase_connected": db_ok,
             "timestamp": datetime.now().isoformat(),
-            "cache_size": len(cache)
+            "cache_size": len(cache),
+            "reservas_ativas": reservas.ativas()
         }), 200 if db_ok else 500
     except Exception as e:
         return jsonify({"status": "down", "error": str(e)}), 500
@@ -83,7 +101,7 @@ def filter_cotas():
         cache_key = f"cotas_{hash(frozenset(filters.items()))}"
         
         if cache_key in cache:
-            return jsonify(cache[cache_key])
+            return jsonify([dict(c, reserva=reservas.valor_publico(c.get('reserva'))) for c in cache[cache_key]])
         
         query = supabase.table('cotas').select('*, administradoras(nome)')
         
@@ -96,7 +114,7 @@ def filter_cotas():
         cotas = query.execute().data
         cache[cache_key] = cotas
         
-        return jsonify(cotas)
+        return jsonify([dict(c, reserva=reservas.valor_publico(c.get('reserva'))) for c in cotas])
         
     except Exception as e:
         logger.error(f"Erro em /api/cotas: {str(e)}", exc_info=True)
@@ -118,6 +136,7 @@ def detalhes_cota(cota_id):
         cota = executor.submit(_fetch_cota).result()
         if not cota:
             return jsonify({'error': 'Cota não encontrada'}), 404
+        cota['reserva'] = reservas.valor_publico(cota.get('reserva'))
         
         # Cálculos financeiros
         credito = float(cota.get('valor_credito', 0))
@@ -164,6 +183,7 @@ def somar_cotas():
     
     try:
         cotas_ids = request.json.get('cotas_ids', [])
+        reserva_token = request.json.get('reserva_token')
         print("IDs recebidos:", cotas_ids)
 
         if not cotas_ids:
@@ -256,7 +276,7 @@ def somar_cotas():
             'JAnual': JAnual,
             'detalhes': detalhes,
             'link_share': link_share,
-            'disponivel': all(c['reserva'] != 'reservado' for c in cotas)
+            'disponivel': all(reservas.disponivel(c, reserva_token) for c in cotas)
         })
         
     except Exception as e:
@@ -272,6 +292,7 @@ def iniciar_negociacao():
         data = request.get_json()
         cotas_ids = data.get('cotas_ids', [])
         tipo_contato = data.get('tipo_contato', 'negociar')
+        reserva_token = data.get('reserva_token')
         
         if not cotas_ids:
             return jsonify({'error': 'Nenhum ID de cota fornecido'}), 400
@@ -291,6 +312,12 @@ def iniciar_negociacao():
         admin_response = supabase.table('administradoras').select('nome').eq('id', primeira_admin).execute()
         nome_admin = admin_response.data[0]['nome'] if admin_response.data else 'Desconhecida'
         
+        # Reserva todas as cotas ou nenhuma, com UPDATE condicional no banco
+        try:
+            reserva = reservas.reservar(cotas, token=reserva_token, cliente=request.remote_addr)
+        except LimiteReserva as e:
+            return jsonify({'error': str(e)}), 429
+        
         resumo = {
             'tipo_contato': tipo_contato,
             'admin': nome_admin,
@@ -305,7 +332,9 @@ def iniciar_negociacao():
             } for c in cotas],
             'total_credito': sum(float(c['valor_credito']) for c in cotas),
             'total_entrada': sum(float(c['entrada']) for c in cotas),
-            'disponivel': all(c['reserva'] != 'reservado' for c in cotas)
+            'disponivel': reserva is not None,
+            'reserva_token': reserva[0] if reserva else None,
+            'reserva_expira_em': datetime.fromtimestamp(reserva[1]).isoformat() if reserva else None
         }
         
         return jsonify(resumo)
@@ -314,6 +343,24 @@ def iniciar_negociacao():
         logger.error(f"Erro ao iniciar negociação: {str(e)}")
         return jsonify({'error': 'Erro interno ao processar a requisição'}), 500
 
+@app.route('/api/liberar_negociacao', methods=['POST'])
+def liberar_negociacao():
+    try:
+        data = request.get_json() or {}
+        reserva_token = data.get('reserva_token')
+        
+        if not reserva_token:
+            return jsonify({'error': 'Nenhum token de reserva fornecido'}), 400
+        
+        if not reservas.liberar(reserva_token):
+            return jsonify({'error': 'Reserva não encontrada ou expirada'}), 404
+        
+        return jsonify({'liberado': True})
+        
+    except Exception as e:
+        logger.error(f"Erro ao liberar negociação: {str(e)}")
+        return jsonify({'error': 'Erro interno ao processar a requisição'}), 500
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
 
@@ -0,0 +1,378 @@
+import hashlib
+import heapq
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+RESERVADO = 'reservado'
+PREFIXO = 'negociacao'
+TOKEN_RE = re.compile(r'[0-9a-f]{32}')
+
+
+class LimiteReserva(Exception):
+    """Pedido de reserva acima dos limites configurados."""
+
+
+# ==================== MARCADORES ====================
+#
+# Uma reserva de negociação é gravada na coluna `reserva` como
+# "negociacao:<hash do token>:<expira_em>:<renovações>:<valor anterior em JSON>".
+# Assim ela se distingue de uma reserva real ('reservado'), expira sozinha
+# mesmo se o processo que a criou morrer, guarda o valor a ser restaurado e
+# o número de renovações, que vale para qualquer worker.
+# Só o hash do token vai para o banco, pois a coluna aparece nas listagens.
+
+def _hash(token):
+    return hashlib.sha256(token.encode()).hexdigest()[:32]
+
+
+def _token_valido(token):
+    return token if isinstance(token, str) and TOKEN_RE.fullmatch(token) else None
+
+
+def marcador(token, expira_em, renovacoes, anterior):
+    return f"{PREFIXO}:{_hash(token)}:{int(expira_em)}:{int(renovacoes)}:{json.dumps(anterior)}"
+
+
+def ler_marcador(valor):
+    """Retorna (hash do token, expira_em, renovações, valor anterior) ou None se `valor` não for um marcador."""
+    if not isinstance(valor, str) or not valor.startswith(PREFIXO + ':'):
+        return None
+    try:
+        _, dono, expira_em, renovacoes, anterior = valor.split(':', 4)
+        return dono, int(expira_em), int(renovacoes), json.loads(anterior)
+    except ValueError:
+        return None
+
+
+def valor_original(valor):
+    """Valor de `reserva` sem o marcador de negociação."""
+    m = ler_marcador(valor)
+    return valor if m is None else m[3]
+
+
+class ReservaManager:
+    """Reservas temporárias de cotas durante a negociação.
+
+    A primeira reserva de cada cota é um UPDATE condicional feito na própria
+    requisição, então o banco decide entre processos concorrentes. Depois
+    disso cada cota reservada fica num dicionário e a consulta de
+    disponibilidade é O(1) por id. Liberações e expirações são gravadas em
+    segundo plano (write-behind), sempre condicionadas ao marcador gravado.
+    """
+
+    def __init__(self, supabase, ttl=900, intervalo_flush=2.0, intervalo_limpeza=60,
+                 margem=30, max_cotas=10, max_por_cliente=3, max_renovacoes=8):
+        self.supabase = supabase
+        self.ttl = ttl
+        self.intervalo_flush = intervalo_flush  # None desativa a thread (flush manual)
+        self.intervalo_limpeza = intervalo_limpeza
+        self.margem = margem  # tolerância antes de considerar expirado o marcador de outro processo
+        self.max_cotas = max_cotas
+        self.max_por_cliente = max_por_cliente
+        self.max_renovacoes = max_renovacoes
+        self._lock = threading.Lock()
+        self._reservas = {}     # cota_id -> token
+        self._por_token = {}    # token -> dados da reserva
+        self._por_cliente = {}  # cliente -> tokens ativos
+        self._expiracoes = []   # heap de (expira_em, token)
+        self._pendentes = {}    # cota_id -> marcador a desfazer no banco
+        self._parar = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    # ==================== CONSULTA ====================
+
+    def reservada(self, cota_id, token=None):
+        """Retorna True se a cota possui reserva ativa de outro token neste processo."""
+        dono = self._reservas.get(cota_id)
+        if dono is None or dono == token:
+            return False
+        reserva = self._por_token.get(dono)
+        return reserva is not None and reserva['expira_em'] > time.time()
+
+    def disponivel(self, cota, token=None):
+        """Disponibilidade de uma linha de `cotas` já lida do banco para o dono de `token`."""
+        token = _token_valido(token)
+        valor = cota.get('reserva')
+        if self.reservada(cota['id'], token):
+            dono = self._reservas.get(cota['id'])
+            m = ler_marcador(valor)
+            if m is not None and dono is not None and m[0] == _hash(dono):
+                return False
+            # O banco não tem mais o marcador (liberado em outro worker ou
+            # alterado pelo administrador): vale o banco
+            self._esquecer(cota['id'], dono)
+        if valor == RESERVADO:
+            return False
+        m = ler_marcador(valor)
+        if m is None:
+            return True
+        return (token is not None and m[0] == _hash(token)) or m[1] + self.margem <= time.time()
+
+    def valor_publico(self, valor):
+        """Valor de `reserva` exibido nas respostas: negociações ativas aparecem como reservadas."""
+        m = ler_marcador(valor)
+        if m is None:
+            return valor
+        return RESERVADO if m[1] > time.time() else m[3]
+
+    def ativas(self):
+        self._garantir_thread()
+        with self._lock:
+            self._expirar(time.time())
+            return len(self._por_token)
+
+    # ==================== RESERVA ====================
+
+    def reservar(self, cotas, token=None, cliente=None):
+        """Reserva todas as cotas ou nenhuma.
+
+        `cotas` são as linhas lidas pela requisição; o valor de `reserva` de
+        cada uma é a condição do UPDATE, em ordem de id. Um `token` existente
+        renova a própria reserva. Retorna (token, expira_em) ou None se alguma
+        cota estiver ocupada; levanta LimiteReserva acima dos limites.
+        """
+        self._garantir_thread()
+        cotas = sorted({c['id']: c for c in cotas}.values(), key=lambda c: c['id'])
+        if not cotas:
+            return None
+        if len(cotas) > self.max_cotas:
+            raise LimiteReserva(f"Máximo de {self.max_cotas} cotas por negociação")
+        token = _token_valido(token)
+
+        agora = int(time.time())
+        with self._lock:
+            self._expirar(agora)
+            local = token in self._por_token
+            if not local and cliente is not None and len(self._por_cliente.get(cliente, ())) >= self.max_por_cliente:
+                raise LimiteReserva('Limite de negociações simultâneas atingido')
+
+        # As renovações são contadas pelos marcadores do próprio token no banco,
+        # então o limite vale mesmo quando cada renovação cai num worker diferente
+        proprios = [m for m in map(ler_marcador, (c.get('reserva') for c in cotas))
+                    if m is not None and token is not None and m[0] == _hash(token)]
+        if token is not None and not proprios and not local:
+            token = None
+        renovacoes = max((m[2] + 1 for m in proprios), default=0)
+        if renovacoes > self.max_renovacoes:
+            raise LimiteReserva('Limite de renovações da reserva atingido')
+        if not all(self.disponivel(c, token) for c in cotas):
+            return None
+
+        token = token or uuid.uuid4().hex
+        expira_em = agora + self.ttl
+        marcadores = self._marcar(cotas, token, expira_em, renovacoes)
+        if marcadores is None:
+            return None
+
+        with self._lock:
+            if token in self._por_token:
+                self._soltar(token, manter=marcadores)
+            for cota_id in marcadores:
+                self._reservas[cota_id] = token
+                self._pendentes.pop(cota_id, None)
+            self._por_token[token] = {
+                'expira_em': expira_em,
+                'cliente': cliente,
+                'marcadores': marcadores,
+            }
+            self._por_cliente.setdefault(cliente, set()).add(token)
+            heapq.heappush(self._expiracoes, (expira_em, token))
+
+        return token, expira_em
+
+    def liberar(self, token):
+        """Libera as cotas de uma reserva. Retorna False se o token não existir."""
+        self._garantir_thread()
+        token = _token_valido(token)
+        if token is None:
+            return False
+        with self._lock:
+            if token in self._por_token:
+                self._soltar(token)
+                return True
+        if not self.supabase:
+            return False
+
+        # Reserva feita por outro worker: procura os marcadores do token no banco
+        resp = (self.supabase.table('cotas').select('id, reserva')
+                .like('reserva', f'{PREFIXO}:{_hash(token)}:%').execute())
+        grupos = {}
+        for c in resp.data:
+            grupos.setdefault(c['reserva'], []).append(c['id'])
+        for valor, ids in grupos.items():
+            self._restaurar(valor, ids)
+        return bool(grupos)
+
+    def _marcar(self, cotas, token, expira_em, renovacoes):
+        # Um UPDATE condicional por valor atual de `reserva`; se alguma cota
+        # mudou desde a leitura, desfaz o que já foi gravado.
+        grupos = {}
+        for c in cotas:
+            grupos.setdefault(c.get('reserva'), []).append(c['id'])
+
+        gravados = {}  # cota_id -> (marcador, valor anterior)
+        completo = True
+        try:
+            for valor, ids in grupos.items():
+                novo = marcador(token, expira_em, renovacoes, valor_original(valor))
+                query = self.supabase.table('cotas').update({'reserva': novo}).in_('id', ids)
+                query = query.is_('reserva', 'null') if valor is None else query.eq('reserva', valor)
+                resp = query.execute()
+                for c in resp.data:
+                    gravados[c['id']] = (novo, valor)
+                if len(resp.data) < len(ids):
+                    completo = False
+                    break
+        except Exception:
+            self._desmarcar(gravados)
+            raise
+
+        if not completo:
+            self._desmarcar(gravados)
+            return None
+        return {cota_id: novo for cota_id, (novo, _) in gravados.items()}
+
+    def _desmarcar(self, gravados):
+        grupos = {}
+        for cota_id, chave in gravados.items():
+            grupos.setdefault(chave, []).append(cota_id)
+        for (novo, valor), ids in grupos.items():
+            try:
+                self.supabase.table('cotas').update({'reserva': valor}).in_('id', ids).eq('reserva', novo).execute()
+            except Exception as e:
+                # O marcador expira e é removido por limpar_orfas
+                logger.error(f"Erro ao desfazer reserva das cotas {ids}: {str(e)}")
+
+    def _soltar(self, token, manter=()):
+        # Chamar com self._lock adquirido
+        reserva = self._por_token.pop(token, None)
+        if reserva is None:
+            return
+        self._remover_cliente(token, reserva['cliente'])
+        for cota_id, valor in reserva['marcadores'].items():
+            if cota_id in manter:
+                continue
+            if self._reservas.get(cota_id) == token:
+                del self._reservas[cota_id]
+            self._pendentes[cota_id] = valor
+
+    def _esquecer(self, cota_id, token):
+        # Remove a cota da reserva local sem gravar nada no banco
+        with self._lock:
+            if self._reservas.get(cota_id) == token:
+                del self._reservas[cota_id]
+            reserva = self._por_token.get(token)
+            if reserva is None:
+                return
+            reserva['marcadores'].pop(cota_id, None)
+            if not reserva['marcadores']:
+                del self._por_token[token]
+                self._remover_cliente(token, reserva['cliente'])
+
+    def _remover_cliente(self, token, cliente):
+        # Chamar com self._lock adquirido
+        tokens_cliente = self._por_cliente.get(cliente)
+        if tokens_cliente is not None:
+            tokens_cliente.discard(token)
+            if not tokens_cliente:
+                del self._por_cliente[cliente]
+
+    def _expirar(self, agora):
+        # Chamar com self._lock adquirido. Entradas antigas de reservas
+        # renovadas ou liberadas são descartadas ao sair do heap.
+        while self._expiracoes and self._expiracoes[0][0] <= agora:
+            expira_em, token = heapq.heappop(self._expiracoes)
+            reserva = self._por_token.get(token)
+            if reserva and reserva['expira_em'] == expira_em:
+                logger.info(f"Reserva {token} expirada: {sorted(reserva['marcadores'])}")
+                self._soltar(token)
+
+    # ==================== PERSISTÊNCIA ====================
+
+    def _garantir_thread(self):
+        # Iniciada no primeiro uso de cada processo, para funcionar também
+        # com `gunicorn --preload`, em que o módulo é importado antes do fork.
+        if self.intervalo_flush is None or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._parar = threading.Event()
+                self._thread = threading.Thread(target=self._loop, name='reservas-flush', daemon=True)
+                self._thread.start()
+
+    def parar(self):
+        if self._pid != os.getpid():
+            return
+        self._parar.set()
+        self._thread.join()
+        self.flush()
+
+    def _loop(self):
+        proxima_limpeza = 0
+        while True:
+            try:
+                with self._lock:
+                    self._expirar(time.time())
+                self.flush()
+                if time.monotonic() >= proxima_limpeza:
+                    self.limpar_orfas()
+                    proxima_limpeza = time.monotonic() + self.intervalo_limpeza
+            except Exception as e:
+                logger.error(f"Erro ao gravar reservas: {str(e)}")
+            if self._parar.wait(self.intervalo_flush):
+                break
+
+    def flush(self):
+        """Restaura no banco as cotas liberadas ou expiradas desde o último flush."""
+        with self._lock:
+            pendentes, self._pendentes = self._pendentes, {}
+        if not pendentes or not self.supabase:
+            return
+
+        grupos = {}
+        for cota_id, valor in pendentes.items():
+            grupos.setdefault(valor, []).append(cota_id)
+
+        restantes = dict(grupos)
+        try:
+            for valor, ids in grupos.items():
+                self._restaurar(valor, ids)
+                del restantes[valor]
+        except Exception:
+            # Devolve as mudanças para a próxima tentativa, sem sobrescrever as mais recentes
+            with self._lock:
+                for valor, ids in restantes.items():
+                    for cota_id in ids:
+                        self._pendentes.setdefault(cota_id, valor)
+            raise
+
+    def limpar_orfas(self):
+        """Restaura marcadores expirados deixados por processos que morreram sem liberá-los."""
+        if not self.supabase:
+            return 0
+        agora = time.time()
+        resp = self.supabase.table('cotas').select('id, reserva').like('reserva', f'{PREFIXO}:%').execute()
+        grupos = {}
+        for c in resp.data:
+            m = ler_marcador(c['reserva'])
+            if m and m[1] + self.margem <= agora:
+                grupos.setdefault(c['reserva'], []).append(c['id'])
+        for valor, ids in grupos.items():
+            logger.info(f"Removendo reserva órfã das cotas {ids}")
+            self._restaurar(valor, ids)
+        return sum(len(ids) for ids in grupos.values())
+
+    def _restaurar(self, valor, ids):
+        # Só altera linhas que ainda têm o marcador gravado por nós; se um
+        # administrador mudou a cota nesse meio tempo, o valor dele prevalece.
+        anterior = ler_marcador(valor)[3]
+        self.supabase.table('cotas').update({'reserva': anterior}).in_('id', sorted(ids)).eq('reserva', valor).execute()
@@ -0,0 +1,82 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import reservas  # noqa: E402
+
+
+class FakeQuery:
+    def __init__(self, linhas, banco, valores=None):
+        self.linhas = linhas
+        self.banco = banco
+        self.valores = valores
+        self.filtros = []
+
+    def in_(self, coluna, valores):
+        self.filtros.append(lambda c: c.get(coluna) in valores)
+        return self
+
+    def eq(self, coluna, valor):
+        self.filtros.append(lambda c: c.get(coluna) == valor)
+        return self
+
+    def gte(self, coluna, valor):
+        self.filtros.append(lambda c: float(c.get(coluna)) >= float(valor))
+        return self
+
+    def is_(self, coluna, valor):
+        assert valor == 'null'
+        self.filtros.append(lambda c: c.get(coluna) is None)
+        return self
+
+    def like(self, coluna, padrao):
+        assert padrao.endswith('%')
+        self.filtros.append(lambda c: isinstance(c.get(coluna), str) and c[coluna].startswith(padrao[:-1]))
+        return self
+
+    def execute(self):
+        if self.banco.falhar:
+            raise RuntimeError('banco indisponível')
+        linhas = [c for c in self.linhas.values() if all(f(c) for f in self.filtros)]
+        if self.valores is not None:
+            for c in linhas:
+                c.update(self.valores)
+        return SimpleNamespace(data=[dict(c) for c in linhas])
+
+
+class FakeTable:
+    def __init__(self, linhas, banco):
+        self.linhas = linhas
+        self.banco = banco
+
+    def select(self, campos):
+        return FakeQuery(self.linhas, self.banco)
+
+    def update(self, valores):
+        return FakeQuery(self.linhas, self.banco, valores)
+
+
+class FakeSupabase:
+    """Cliente Supabase em memória com os filtros usados pela API."""
+
+    def __init__(self, reservas_por_id, **campos):
+        self.cotas = {i: dict(campos, id=i, reserva=r) for i, r in reservas_por_id.items()}
+        self.administradoras = {}
+        self.falhar = False
+
+    def table(self, nome):
+        return FakeTable(getattr(self, nome), self)
+
+    def ler(self, *ids):
+        return [{'id': i, 'reserva': self.cotas[i]['reserva']} for i in ids]
+
+
+@pytest.fixture
+def relogio(monkeypatch):
+    agora = SimpleNamespace(t=1_000_000)
+    monkeypatch.setattr(reservas.time, 'time', lambda: agora.t)
+    return agora
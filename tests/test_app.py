@@ -0,0 +1,86 @@
+import os
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+os.environ['SUPABASE_URL'] = ''  # impede a conexão com o Supabase real ao importar app
+
+import app as api  # noqa: E402
+from conftest import FakeSupabase  # noqa: E402
+from reservas import PREFIXO, ReservaManager  # noqa: E402
+
+CAMPOS = {
+    'valor_credito': 100000, 'entrada': 20000, 'saldo': 90000, 'parcelas': 100,
+    'valor_parcela': 900, 'administradora_id': 7, 'categoria': 'imovel',
+    'vencimento': 10, 'codigo': 'C1',
+}
+
+
+@pytest.fixture
+def cliente(monkeypatch, relogio):
+    banco = FakeSupabase({1: None, 2: 'disponivel', 3: 'reservado'}, **CAMPOS)
+    banco.administradoras = {7: {'id': 7, 'nome': 'Admin X'}}
+    gerenciador = ReservaManager(banco, intervalo_flush=None, max_cotas=2, max_por_cliente=1)
+    monkeypatch.setattr(api, 'supabase', banco)
+    monkeypatch.setattr(api, 'reservas', gerenciador)
+    api.cache.clear()
+    return SimpleNamespace(http=api.app.test_client(), banco=banco, reservas=gerenciador)
+
+
+def _negociar(cliente, ids, ip='10.0.0.1', **dados):
+    return cliente.http.post('/api/iniciar_negociacao', json=dict(dados, cotas_ids=ids),
+                             environ_base={'REMOTE_ADDR': ip})
+
+
+def test_iniciar_negociacao_reserva_e_somar_cotas_reconhece_o_dono(cliente, relogio):
+    resp = _negociar(cliente, [1, 2])
+    assert resp.status_code == 200
+    dados = resp.get_json()
+    assert dados['disponivel'] is True
+    assert dados['reserva_expira_em'] == datetime.fromtimestamp(relogio.t + cliente.reservas.ttl).isoformat()
+    token = dados['reserva_token']
+
+    outro = _negociar(cliente, [2], ip='10.0.0.2').get_json()
+    assert outro['disponivel'] is False and outro['reserva_token'] is None
+
+    somar = lambda **extra: cliente.http.post('/api/somar_cotas', json=dict(extra, cotas_ids=[1, 2])).get_json()
+    assert somar(reserva_token=token)['disponivel'] is True
+    assert somar()['disponivel'] is False
+    assert somar(reserva_token=123)['disponivel'] is False
+
+
+def test_listagens_nao_expoem_marcador(cliente):
+    _negociar(cliente, [1])
+
+    resp = cliente.http.post('/api/cotas', json={})
+    assert PREFIXO not in resp.get_data(as_text=True)
+    assert {c['id']: c['reserva'] for c in resp.get_json()} == {1: 'reservado', 2: 'disponivel', 3: 'reservado'}
+
+    detalhes = cliente.http.get('/api/detalhes_cota/1').get_json()
+    assert detalhes['cota']['reserva'] == 'reservado'
+
+
+def test_liberar_negociacao(cliente):
+    token = _negociar(cliente, [1, 2]).get_json()['reserva_token']
+    liberar = lambda corpo: cliente.http.post('/api/liberar_negociacao', json=corpo)
+
+    assert liberar({}).status_code == 400
+    assert liberar({'reserva_token': 10 ** 31}).status_code == 404
+    assert liberar({'reserva_token': token}).get_json() == {'liberado': True}
+
+    cliente.reservas.flush()
+    assert cliente.banco.cotas[1]['reserva'] is None
+    assert cliente.banco.cotas[2]['reserva'] == 'disponivel'
+    assert liberar({'reserva_token': token}).status_code == 404
+
+
+def test_limites_de_negociacao(cliente):
+    assert _negociar(cliente, [1, 2, 3]).status_code == 429
+    assert _negociar(cliente, [1, 1, 2]).get_json()['disponivel'] is True
+
+    # X-Forwarded-For não muda o cliente sem proxy configurado
+    resp = cliente.http.post('/api/iniciar_negociacao', json={'cotas_ids': [3]},
+                             environ_base={'REMOTE_ADDR': '10.0.0.1'},
+                             headers={'X-Forwarded-For': '203.0.113.9'})
+    assert resp.status_code == 429
@@ -0,0 +1,176 @@
+import pytest
+
+from conftest import FakeSupabase
+from reservas import LimiteReserva, ReservaManager, ler_marcador
+
+
+def _manager(banco, **kwargs):
+    return ReservaManager(banco, intervalo_flush=None, **kwargs)
+
+
+def test_reserva_tudo_ou_nada(relogio):
+    banco = FakeSupabase({1: None, 2: 'disponivel', 3: 'reservado'})
+    r = _manager(banco)
+
+    assert r.reservar(banco.ler(1, 2, 3)) is None
+    assert banco.ler(1, 2) == [{'id': 1, 'reserva': None}, {'id': 2, 'reserva': 'disponivel'}]
+
+    token, expira_em = r.reservar(banco.ler(1, 2))
+    assert expira_em == relogio.t + r.ttl
+    assert ler_marcador(banco.cotas[1]['reserva'])[3] is None
+    assert ler_marcador(banco.cotas[2]['reserva'])[3] == 'disponivel'
+    assert r.disponivel(banco.cotas[1], token)
+    assert not r.disponivel(banco.cotas[1])
+    assert r.valor_publico(banco.cotas[2]['reserva']) == 'reservado'
+
+
+def test_conflito_entre_workers_desfaz_reserva_parcial(relogio):
+    banco = FakeSupabase({1: None, 2: 'vendido', 3: None})
+    worker_a = _manager(banco)
+    worker_b = _manager(banco)
+
+    lidas_por_b = banco.ler(1, 2, 3)
+    assert worker_a.reservar(banco.ler(3)) is not None
+
+    # B leu a cota 3 livre, mas A a reservou antes do UPDATE de B
+    assert worker_b.reservar(lidas_por_b) is None
+    assert banco.cotas[1]['reserva'] is None
+    assert banco.cotas[2]['reserva'] == 'vendido'
+    assert worker_b.ativas() == 0
+
+
+def test_renovacao_com_token_e_entradas_antigas_do_heap(relogio):
+    banco = FakeSupabase({1: None, 2: None})
+    r = _manager(banco, ttl=10, max_renovacoes=1)
+
+    token, _ = r.reservar(banco.ler(1, 2))
+    relogio.t += 5
+    assert r.reservar(banco.ler(1, 2), token=token) == (token, relogio.t + 10)
+    assert ler_marcador(banco.cotas[1]['reserva'])[1] == relogio.t + 10
+
+    # A entrada do heap da primeira reserva vence, mas a renovação continua ativa
+    relogio.t += 6
+    assert r.ativas() == 1
+    assert r.reservada(1)
+
+    with pytest.raises(LimiteReserva):
+        r.reservar(banco.ler(1, 2), token=token)
+
+    relogio.t += 5
+    assert r.ativas() == 0
+    r.flush()
+    assert banco.ler(1, 2) == [{'id': 1, 'reserva': None}, {'id': 2, 'reserva': None}]
+
+
+def test_renovacao_em_outro_worker(relogio):
+    banco = FakeSupabase({1: 'disponivel'})
+    worker_a = _manager(banco)
+    worker_b = _manager(banco)
+
+    token, _ = worker_a.reservar(banco.ler(1))
+    assert worker_b.reservar(banco.ler(1)) is None
+    assert worker_b.reservar(banco.ler(1), token=token)[0] == token
+    assert worker_b.liberar(token)
+    worker_b.flush()
+    assert banco.cotas[1]['reserva'] == 'disponivel'
+
+
+def test_liberacao_em_outro_worker_vale_no_worker_de_origem(relogio):
+    banco = FakeSupabase({1: None})
+    worker_a = _manager(banco)
+    worker_b = _manager(banco)
+
+    token, _ = worker_a.reservar(banco.ler(1))
+    assert worker_b.liberar(token)
+    assert banco.cotas[1]['reserva'] is None
+
+    assert worker_a.disponivel(banco.ler(1)[0])
+    assert not worker_a.reservada(1)
+    assert worker_a.ativas() == 0
+    assert worker_a.reservar(banco.ler(1)) is not None
+
+
+def test_limite_de_renovacoes_vale_entre_workers(relogio):
+    banco = FakeSupabase({1: None})
+    workers = [_manager(banco, max_renovacoes=2) for _ in range(3)]
+
+    token, _ = workers[0].reservar(banco.ler(1))
+    assert workers[1].reservar(banco.ler(1), token=token)[0] == token
+    assert workers[2].reservar(banco.ler(1), token=token)[0] == token
+    assert ler_marcador(banco.cotas[1]['reserva'])[2] == 2
+    for worker in workers:
+        with pytest.raises(LimiteReserva):
+            worker.reservar(banco.ler(1), token=token)
+
+
+def test_token_invalido_e_ignorado(relogio):
+    banco = FakeSupabase({1: None})
+    r = _manager(banco)
+    r.reservar(banco.ler(1))
+
+    assert not r.disponivel(banco.ler(1)[0], 123)
+    assert not r.liberar(10 ** 31)
+    assert not r.liberar('x' * 32)
+    assert r.reservar(banco.ler(1), token=123) is None
+
+
+def test_expiracao_restaura_valor_anterior_e_respeita_admin(relogio):
+    banco = FakeSupabase({1: None, 2: 'vendido'})
+    r = _manager(banco, ttl=10)
+
+    token, _ = r.reservar(banco.ler(1, 2))
+    banco.cotas[1]['reserva'] = 'reservado'  # venda real feita pelo administrador
+    relogio.t += 11
+    assert r.ativas() == 0
+    r.flush()
+    assert banco.cotas[1]['reserva'] == 'reservado'
+    assert banco.cotas[2]['reserva'] == 'vendido'
+    assert not r.liberar(token)
+
+
+def test_flush_com_falha_recoloca_pendentes(relogio):
+    banco = FakeSupabase({1: None})
+    r = _manager(banco)
+
+    token, _ = r.reservar(banco.ler(1))
+    assert r.liberar(token)
+
+    banco.falhar = True
+    with pytest.raises(RuntimeError):
+        r.flush()
+    assert ler_marcador(banco.cotas[1]['reserva']) is not None
+
+    banco.falhar = False
+    r.flush()
+    assert banco.cotas[1]['reserva'] is None
+
+
+def test_limpar_orfas(relogio):
+    banco = FakeSupabase({1: None, 2: 'disponivel'})
+    morto = _manager(banco, ttl=10)
+    morto.reservar(banco.ler(1))
+    vivo = _manager(banco, ttl=100)
+    vivo.reservar(banco.ler(2))
+
+    novo = _manager(banco, margem=30)
+    relogio.t += 20
+    assert novo.limpar_orfas() == 0
+    relogio.t += 20
+    assert novo.limpar_orfas() == 1
+    assert banco.cotas[1]['reserva'] is None
+    assert ler_marcador(banco.cotas[2]['reserva']) is not None
+
+
+def test_limites_por_negociacao_e_cliente(relogio):
+    banco = FakeSupabase({i: None for i in range(1, 6)})
+    r = _manager(banco, max_cotas=2, max_por_cliente=1)
+
+    with pytest.raises(LimiteReserva):
+        r.reservar(banco.ler(1, 2, 3), cliente='1.2.3.4')
+    token, _ = r.reservar(banco.ler(1, 2), cliente='1.2.3.4')
+    with pytest.raises(LimiteReserva):
+        r.reservar(banco.ler(3), cliente='1.2.3.4')
+    assert r.reservar(banco.ler(3), cliente='5.6.7.8') is not None
+
+    r.liberar(token)
+    assert r.reservar(banco.ler(4), cliente='1.2.3.4') is not None